@@ -17,11 +17,15 @@
 # along with pywebcal.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import StringIO
 import datetime
 import logging
 import pickle
 import hashlib
+import heapq
+import random
+import threading
+import time
+from collections import OrderedDict
 from os import path, environ
 
 try:
@@ -48,6 +52,9 @@ except ImportError:
 install python webdav library (https://code.launchpad.net/python-webdav-lib/)"""
     sys.exit(1)
 
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
 class WebCal(object):
     """
     Class providing simple cached access to iCal calendars over WebDAV
@@ -67,6 +74,7 @@ class WebCal(object):
         self.connection = None
         self._modifiedTimes = {}
         self._cache = None
+        self._parsers = {}
         self._connID = ConnID(webdavURL, username)
         self._cache_file = "%s.%s" % (self._cache_file, self._connID.digest)
 
@@ -92,10 +100,19 @@ class WebCal(object):
                                                            gettz("UTC"))
         return ret
 
-    def get_calendar(self, uid):
-        """get_calendar(uid) -> ICal
+    def get_calendar(self, uid, shared = False):
+        """get_calendar(uid, shared=False) -> ICal
 
         Returns Calendar instance from webdav URL identified by uid.
+
+        shared - by default whole calendar is parsed and every returned
+                 instance is independent. With shared=True only events
+                 changed since previous shared call are parsed again and
+                 components of unchanged events are shared between
+                 returned instances. Event setters copy an event before
+                 changing it, but such calendar must not be changed
+                 directly through vobject (ICal.ical or Event.ical), that
+                 would change results of later calls
         """
         if not self.connection:
             self._connect()
@@ -107,13 +124,16 @@ class WebCal(object):
         cc = self.__get_cached_calendar(uid)
         if cc and cc[0] == modified: # calendar is cached
             data = cc[1]
-            vcal = vobject.base.readComponents(StringIO.StringIO(data[0])).next()
-            c = ICal(vcal)
+            text = data[0]
         else:
-            vcal = vobject.base.readComponents(rs.downloadContent().read()).next()
-            c = ICal(vcal)
-            self.__set_cached_calendar(uid, modified, (vcal.serialize(),))
-        return c
+            text = rs.downloadContent().read()
+            self.__set_cached_calendar(uid, modified, (text,))
+        if shared:
+            parser = self._parsers.setdefault(uid, _IncrementalParser())
+            vcal = parser.parse(text)
+        else:
+            vcal = vobject.readOne(text)
+        return ICal(vcal, modified, shared)
 
     def get_all_events(self):
         """get_all_events() -> [Event, Event1,...]
@@ -168,14 +188,366 @@ class WebCal(object):
         with open(self._cache_file, 'w') as cacheFile:
             pickle.dump(self._cache, cacheFile)
 
+class CalendarRefresher(object):
+    """
+    Class keeping calendars of several WebCal connections fresh in the
+    background
+
+    Reads return last fetched ICal instances right away. When they are
+    older than refresh interval, connection is scheduled for immediate
+    revalidation and stale data is returned in the meantime. Only the
+    very first read of a connection blocks on the network.
+
+    Returned ICal instances share components with later refreshes (see
+    WebCal.get_calendar) and must be changed only through Event setters.
+    """
+
+    def __init__(self, connections, interval = 300, jitter = 0.1, retry = 30,
+                 max_backoff = 3600, clock = time.time, rand = None):
+        """connections - list of WebCal instances to keep fresh
+        interval - number of seconds after which calendars are considered
+                   stale and are fetched again
+        jitter - fraction of interval by which refresh times are randomly
+                 spread so that connections are not refreshed all at once
+        retry - number of seconds to wait before first retry of failed
+                refresh. Every following failure doubles this time
+        max_backoff - maximum number of seconds between retries
+        clock - function returning current time in seconds
+        rand - random.Random instance used for jitter
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._random = rand or random.Random()
+        self._lock = threading.Condition()
+        self._states = {}
+        self._thread = None
+        self._stopping = False
+        for conn in connections:
+            self.add(conn)
+
+    def add(self, connection):
+        """add(connection)
+
+        Starts keeping calendars of given WebCal connection fresh. First
+        refresh is scheduled immediately
+        """
+        with self._lock:
+            if connection not in self._states:
+                self._states[connection] = _RefreshState(connection, self._clock())
+                self._lock.notify()
+
+    def get_calendar_uids(self, connection):
+        """get_calendar_uids(connection) -> [uid, uid1, ...]
+
+        Returns list of calendar UIDs last seen in given connection.
+        """
+        state = self._get_state(connection)
+        if state.uids is None:
+            self._cold_read(state)
+        else:
+            self._revalidate_stale(state)
+        return list(state.uids)
+
+    def get_calendar(self, connection, uid):
+        """get_calendar(connection, uid) -> ICal
+
+        Returns last fetched ICal instance identified by uid from given
+        connection. KeyError is raised if there is no such calendar.
+
+        If nothing has been fetched from connection yet, this blocks on
+        the network. When that fails, the error is raised and following
+        reads raise it again without contacting server until the
+        connection's backoff time passes
+        """
+        state = self._get_state(connection)
+        if state.uids is None:
+            self._cold_read(state)
+        else:
+            self._revalidate_stale(state)
+        return state.calendars[uid]
+
+    def run_pending(self):
+        """run_pending() -> int
+
+        Refreshes all connections that are due for refresh and returns
+        number of successfully refreshed connections. Failed refreshes
+        are logged and retried later with exponential backoff
+        """
+        return self._run_pending(False)
+
+    def _run_pending(self, stoppable):
+        # stoppable - give up remaining refreshes when stop() is called
+        now = self._clock()
+        with self._lock:
+            due = [st for st in self._states.values() if st.due <= now]
+        done = 0
+        for state in due:
+            if stoppable and self._stopping:
+                break
+            try:
+                self._refresh(state)
+                done += 1
+            except Exception, e:
+                self._failed(state, e)
+        return done
+
+    def start(self):
+        """start()
+
+        Starts background thread refreshing calendars
+        """
+        with self._lock:
+            self._stopping = False
+            if self._thread:
+                # thread which did not finish after stop() is reused
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='pywebcal-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout = None):
+        """stop(timeout=None)
+
+        Stops background thread and waits for it to finish refresh that
+        might be in progress. If timeout elapses first, the thread stops
+        after the refresh finishes
+        """
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+            self._lock.notify()
+        if thread:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopping:
+                    self._thread = None
+                    return
+                wait = min([st.due for st in self._states.values()] or
+                           [self._clock() + self.interval]) - self._clock()
+                if wait > 0:
+                    self._lock.wait(min(wait, self.interval))
+                    continue
+            self._run_pending(True)
+
+    def _get_state(self, connection):
+        with self._lock:
+            if connection not in self._states:
+                self._states[connection] = _RefreshState(connection, self._clock())
+            return self._states[connection]
+
+    def _revalidate_stale(self, state):
+        # connections backing off after failure are left alone so that
+        # frequent reads do not turn into frequent retries
+        now = self._clock()
+        with self._lock:
+            if (state.failures == 0 and now - state.fetched >= self.interval
+                and state.due > now):
+                state.due = now
+                self._lock.notify()
+
+    def _cold_read(self, state):
+        with self._lock:
+            if state.failures and self._clock() < state.due:
+                raise state.error
+        try:
+            self._refresh(state)
+        except Exception, e:
+            self._failed(state, e)
+            raise
+
+    def _refresh(self, state):
+        with state.fetch_lock:
+            conn = state.connection
+            uids = conn.get_calendar_uids()
+            calendars = {}
+            for uid in uids:
+                calendars[uid] = conn.get_calendar(uid, shared=True)
+            now = self._clock()
+            with self._lock:
+                state.uids = uids
+                state.calendars = calendars
+                state.fetched = now
+                state.failures = 0
+                state.error = None
+                state.due = now + self._spread(self.interval)
+
+    def _failed(self, state, error):
+        with self._lock:
+            state.failures += 1
+            state.error = error
+            delay = min(self.retry * 2 ** (state.failures - 1), self.max_backoff)
+            state.due = self._clock() + self._spread(delay)
+        log.warning("Refresh of %r failed (%d in a row): %s",
+                    state.connection, state.failures, error)
+
+    def _spread(self, delay):
+        return delay + delay * self.jitter * self._random.uniform(-1, 1)
+
+class _RefreshState(object):
+    """Holds refresh bookkeeping for single connection"""
+
+    def __init__(self, connection, due):
+        self.connection = connection
+        self.uids = None
+        self.calendars = {}
+        self.fetched = None
+        self.failures = 0
+        self.error = None
+        self.due = due
+        self.fetch_lock = threading.Lock()
+
+class _IncrementalParser(object):
+    """
+    Parses iCalendar text reusing components parsed by previous call
+
+    Text is split into VEVENT and VTIMEZONE blocks which are identified
+    by hash of their text. Only blocks not seen in previously parsed
+    text are given to vobject, the rest is taken over from previous
+    result. When any VTIMEZONE changes all blocks are parsed again
+    because events refer to timezones.
+    """
+
+    _split_components = ('BEGIN:VEVENT', 'BEGIN:VTIMEZONE')
+
+    def __init__(self):
+        self._components = {}
+
+    def parse(self, text):
+        """parse(text) -> vobject.icalendar.VCalendar2_0
+
+        Returns calendar parsed from iCalendar text. Returned VEVENT and
+        VTIMEZONE components are part of later results and must not be
+        modified.
+        """
+        skeleton, begin, end, blocks = self._split(text)
+        if begin is None or end is None:
+            # not a single well formed VCALENDAR, leave it to vobject
+            self._components = {}
+            return vobject.readOne(text)
+
+        tz_changed = any([h not in self._components
+                          for kind, h, data in blocks if kind == 'vtimezone'])
+
+        components = [None] * len(blocks)
+        pending = []
+        used = set()
+        for i, (kind, h, data) in enumerate(blocks):
+            if not tz_changed and h in self._components and h not in used:
+                components[i] = self._components[h]
+                used.add(h)
+            else:
+                pending.append(i)
+
+        if pending:
+            # changed events are parsed together with all timezones so
+            # that their TZIDs can be resolved
+            tzs = [i for i, (kind, h, data) in enumerate(blocks)
+                   if kind == 'vtimezone']
+            events = [i for i in pending if blocks[i][0] == 'vevent']
+            batch = vobject.readOne(''.join([skeleton[begin]] +
+                                            [blocks[i][2] for i in tzs + events] +
+                                            [skeleton[end]]))
+            parsed = dict(zip(tzs, batch.contents.get('vtimezone', [])))
+            parsed.update(zip(events, batch.contents.get('vevent', [])))
+            for i in pending:
+                components[i] = parsed[i]
+
+        vcal = vobject.readOne(''.join(skeleton))
+        self._components = {}
+        for (kind, h, data), component in zip(blocks, components):
+            vcal.add(component)
+            self._components.setdefault(h, component)
+        return vcal
+
+    def _split(self, text):
+        # returns lines outside of split components, indexes of first
+        # VCALENDAR's BEGIN and END lines among them (None when missing)
+        # and list of (kind, hash, text) tuples of components split from
+        # that VCALENDAR
+        skeleton = []
+        begin = end = None
+        blocks = []
+        block = None
+        level = 0
+        for line in text.splitlines(True):
+            upper = line.rstrip().upper()
+            if block is not None:
+                block.append(line)
+                if upper.startswith('BEGIN:'):
+                    depth += 1
+                elif upper.startswith('END:'):
+                    depth -= 1
+                    if depth == 0:
+                        data = ''.join(block)
+                        if isinstance(data, unicode):
+                            digest = hashlib.md5(data.encode('utf-8'))
+                        else:
+                            digest = hashlib.md5(data)
+                        blocks.append((kind, digest.hexdigest(), data))
+                        block = None
+            elif (upper in self._split_components and level == 1 and
+                  begin is not None and end is None):
+                block = [line]
+                kind = upper[6:].lower()
+                depth = 1
+            else:
+                if upper.startswith('BEGIN:'):
+                    if upper == 'BEGIN:VCALENDAR' and level == 0 and begin is None:
+                        begin = len(skeleton)
+                    level += 1
+                elif upper.startswith('END:'):
+                    level -= 1
+                    if (upper == 'END:VCALENDAR' and level == 0 and
+                        begin is not None and end is None):
+                        end = len(skeleton)
+                skeleton.append(line)
+        if block is not None:
+            # unterminated component
+            end = None
+        return skeleton, begin, end, blocks
+
 class ICal(object):
-    """High-level interface for working with iCal files"""
+    """High-level interface for working with iCal files
+
+    Results of events_before, events_between and events_after are
+    remembered for last _query_cache_size windows. They are keyed by
+    calendar version and number of changes made through Event setters,
+    so the cache is dropped on every edit. Changes made directly to
+    underlying vobject are not noticed, call clear_query_cache() after
+    making them. The cache may be used from several threads at once.
+
+    Occurrences of recurring events that are overridden by an event with
+    the same UID and RECURRENCE-ID are skipped, next occurrence of the
+    recurring event is used instead.
+    """
+    _query_cache_size = 128
 
-    def __init__(self, vobj):
+    def __init__(self, vobj, version = None, shared = False):
         """Initializes class with given vobject.icalendar.VCalendar2_0
         instance
+
+        version - identification of calendar contents (e.g. last
+                  modification time) used as part of query cache keys
+        shared - True if vevent components may be shared with other ICal
+                 instances. They are then copied before first change
+                 through Event setters
         """
         self.ical = vobj
+        self.version = version
+        self._shared = shared
+        self._copies = {}
+        self._private = set()
+        self._mutations = 0
+        self._query_cache = OrderedDict()
+        self._query_lock = threading.Lock()
+        self._overrides = (None, None)
 
     def get_event_ids(self):
         """get_event_ids() -> [uid, uid1, ...]
@@ -201,7 +573,7 @@ class ICal(object):
         ret = []
         try:
             for event in self.ical.vevent_list:
-                ret.append(Event(self.ical, event))
+                ret.append(Event(self.ical, event, self))
         except AttributeError, e:
             # this means ical has no events, maybe just todos?
             # one way or the other -> ignore and return empty list
@@ -215,12 +587,137 @@ class ICal(object):
         where datetime represents date of nearest occurrence (start) of given
         event before dt datetime object
         """
+        return list(self._cached_query('before', (dt,)))
+
+    def events_between(self, dtstart, dtend):
+        """events_before(datetime) -> [(datetime, Event), (datetime1, Event1), ...]
+
+        Returns list of tuples of (datetime.datetime, Event UID)
+        where datetime represents date of occurrence (start) of given
+        event between dtstart and dtend datetime objects
+        """
+        return list(self._cached_query('between', (dtstart, dtend)))
+
+    def events_after(self, dt):
+        """events_after(datetime) -> [(datetime, Event), (datetime1, Event1), ...]
+
+        Returns list of tuples of (datetime.datetime, Event UID)
+        where datetime represents date of nearest occurrence (start) of given
+        event after dt datetime object
+        """
+        return list(self._cached_query('after', (dt,)))
+
+    def clear_query_cache(self):
+        """clear_query_cache()
+
+        Forgets all remembered results of events_* queries
+        """
+        with self._query_lock:
+            self._query_cache.clear()
+
+    def _touch(self):
+        # called by Event setters after change
+        with self._query_lock:
+            self._mutations += 1
+            self._query_cache.clear()
+
+    def _current(self, component):
+        # returns private copy of component if one has been made
+        entry = self._copies.get(id(component))
+        if entry:
+            return entry[1]
+        return component
+
+    def _writable(self, component):
+        # called by Event setters before change, returns component that
+        # can be changed without affecting other ICal instances
+        with self._query_lock:
+            component = self._current(component)
+            if not self._shared or id(component) in self._private:
+                return component
+            events = self.ical.contents['vevent']
+            for i, c in enumerate(events):
+                if c is component:
+                    copy = component.duplicate(component)
+                    events[i] = copy
+                    # original is kept referenced so that its id stays unique
+                    self._copies[id(component)] = (component, copy)
+                    self._private.add(id(copy))
+                    return copy
+            return component
+
+    def _get_overrides(self):
+        # returns {uid: {_sort_key(recurrence-id): recurrence-id}} of
+        # events overriding occurrences of recurring events, computed
+        # once per version
+        key = (self.version, self._mutations)
+        cached_key, overrides = self._overrides
+        if cached_key != key or overrides is None:
+            overrides = {}
+            for e in self.get_events():
+                rid = e.get_recurrence_id()
+                if rid is not None:
+                    overrides.setdefault(e.uid, {})[_sort_key(rid)] = rid
+            self._overrides = (key, overrides)
+        return overrides
+
+    def _cached_query(self, kind, window, extra = None, sort = False):
+        # returns shared result list of events_<kind> query, callers
+        # must not change it. extra - overrides from other calendars in
+        # the same format as _get_overrides(). With sort the result is
+        # list of (_sort_key(dt), position, dt, Event) ordered by time
+        # timezone is part of the key because date() of the window
+        # boundaries is used for all-day events
+        window_key = tuple([(dt.replace(tzinfo=None), dt.utcoffset())
+                            for dt in window])
+        extra_key = None
+        if extra:
+            extra_key = frozenset([(uid, k) for uid, rids in extra.items()
+                                   for k in rids])
+        with self._query_lock:
+            key = (self.version, self._mutations, kind, window_key, extra_key,
+                   sort)
+            ret = self._query_cache.pop(key, None)
+            if ret is not None:
+                self._query_cache[key] = ret
+                return ret
+
+        # query runs unlocked, result computed before an edit is stored
+        # under old mutation count and never found again
+        if sort:
+            result = self._cached_query(kind, window, extra)
+            ret = sorted([(_sort_key(dt), pos, dt, e)
+                          for pos, (dt, e) in enumerate(result)])
+        else:
+            overrides = self._get_overrides()
+            if extra:
+                overrides = _merge_overrides(overrides, extra)
+            query = getattr(self, '_events_' + kind)
+            ret = query(*(window + (overrides,)))
+        with self._query_lock:
+            self._query_cache.pop(key, None)
+            while len(self._query_cache) >= self._query_cache_size:
+                self._query_cache.popitem(last=False)
+            self._query_cache[key] = ret
+        return ret
+
+    def _get_rruleset(self, event, overrides):
+        # returns rruleset of event without overridden occurrences
+        rule = event.get_rruleset()
+        rids = overrides.get(event.uid)
+        if rule and rids and event.get_recurrence_id() is None:
+            start = event.get_start_datetime()
+            for rid in rids.values():
+                rule.exdate(_exdate(rid, start))
+        return rule
+
+    def _events_before(self, dt, overrides):
         ret = []
         es = self.get_events()
         # prepare timeless date in case it's needed
         d = dt.date()
         for e in es:
-            rule = e.get_rruleset()
+            rule = self._get_rruleset(e, overrides)
             sdate = e.get_start_datetime()
             if type(sdate) == datetime.date:
                 cmpdate = d
@@ -232,27 +729,21 @@ class ICal(object):
             else:
                 dr = None
                 try:
-                    dr = rule.after(cmpdate, inc=True)
-                except TypeError, e:
+                    dr = rule.before(cmpdate, inc=True)
+                except TypeError:
                     cmpdate = cmpdate.replace(tzinfo=None)
                     dr = rule.before(cmpdate, inc=True)
                 if dr:
                     ret.append((dr, e))
         return ret
 
-    def events_between(self, dtstart, dtend):
-        """events_before(datetime) -> [(datetime, Event), (datetime1, Event1), ...]
-
-        Returns list of tuples of (datetime.datetime, Event UID)
-        where datetime represents date of occurrence (start) of given
-        event between dtstart and dtend datetime objects
-        """
+    def _events_between(self, dtstart, dtend, overrides):
         ret = []
         es = self.get_events()
         # prepare timeless starts-stops
         dstart, dend = dtstart.date(), dtend.date()
         for e in es:
-            rule = e.get_rruleset()
+            rule = self._get_rruleset(e, overrides)
             sdate = e.get_start_datetime()
             if type(sdate) == datetime.date:
                 cmpstart, cmpend = dstart, dend
@@ -276,19 +767,13 @@ class ICal(object):
                     ret.append((dr, e))
         return ret
 
-    def events_after(self, dt):
-        """events_after(datetime) -> [(datetime, Event), (datetime1, Event1), ...]
-
-        Returns list of tuples of (datetime.datetime, Event UID)
-        where datetime represents date of nearest occurrence (start) of given
-        event after dt datetime object
-        """
+    def _events_after(self, dt, overrides):
         ret = []
         es = self.get_events()
         # prepare timeless date in case it's needed
         d = dt.date()
         for e in es:
-            rule = e.get_rruleset()
+            rule = self._get_rruleset(e, overrides)
             sdate = e.get_start_datetime()
             if type(sdate) == datetime.date:
                 cmpdate = d
@@ -301,7 +786,7 @@ class ICal(object):
                 dr = None
                 try:
                     dr = rule.after(cmpdate, inc=True)
-                except TypeError, e:
+                except TypeError:
                     cmpdate = cmpdate.replace(tzinfo=None)
                     dr = rule.after(cmpdate, inc=True)
                 if dr:
@@ -320,16 +805,161 @@ class ICal(object):
             tzids.append(tz['TZID'])
         return tzids
 
+class CalendarSet(object):
+    """
+    Merged read-only view of several calendars
+
+    Events present in more calendars (same UID and RECURRENCE-ID) are
+    returned only once, from the first calendar containing them.
+    Occurrences of recurring events that are overridden by an event with
+    RECURRENCE-ID in any of the calendars are replaced by the overriding
+    event.
+
+    Results of every calendar are sorted once per calendar version and
+    query window and kept in the calendar's query cache. Merging them
+    is lazy, so only consumed part of the merged result is compared.
+    """
+
+    def __init__(self, calendars, refresher = None):
+        """calendars - list of ICal instances or WebCal instance whose
+                    calendars should be merged
+        refresher - CalendarRefresher used to read calendars of WebCal
+                    instance. Without it every query lists and
+                    fetches all calendars of the WebCal instance
+        """
+        self._calendars = calendars
+        self._refresher = refresher
+
+    def get_calendars(self):
+        """get_calendars() -> [ICal, ICal1, ...]
+
+        Returns list of merged calendars
+        """
+        if isinstance(self._calendars, WebCal):
+            wc = self._calendars
+            source = self._refresher
+            if source:
+                return [source.get_calendar(wc, uid)
+                        for uid in source.get_calendar_uids(wc)]
+            return [wc.get_calendar(uid) for uid in wc.get_calendar_uids()]
+        return list(self._calendars)
+
+    def events_before(self, dt):
+        """events_before(datetime) -> iterator of (datetime, Event)
+
+        Same as ICal.events_before for all merged calendars, ordered
+        by datetime of occurrence
+        """
+        return self._merge('before', (dt,))
+
+    def events_between(self, dtstart, dtend):
+        """events_between(dtstart, dtend) -> iterator of (datetime, Event)
+
+        Same as ICal.events_between for all merged calendars, ordered
+        by datetime of occurrence
+        """
+        return self._merge('between', (dtstart, dtend))
+
+    def events_after(self, dt):
+        """events_after(datetime) -> iterator of (datetime, Event)
+
+        Same as ICal.events_after for all merged calendars, ordered
+        by datetime of occurrence
+        """
+        return self._merge('after', (dt,))
+
+    def _merge(self, kind, window):
+        calendars = self.get_calendars()
+        # override in one calendar replaces occurrence in any calendar
+        overrides = {}
+        for cal in calendars:
+            overrides = _merge_overrides(overrides, cal._get_overrides())
+        streams = []
+        for i, cal in enumerate(calendars):
+            # calendar index and position keep ordering of
+            # simultaneous events stable
+            streams.append(_tag_stream(
+                cal._cached_query(kind, window, overrides, True), i))
+
+        seen = set()
+        for key, i, pos, dt, e in heapq.merge(*streams):
+            rid = e.get_recurrence_id()
+            if rid is None:
+                ident = (e.uid, None)
+            else:
+                ident = (e.uid, _sort_key(rid))
+            if ident in seen:
+                continue
+            seen.add(ident)
+            yield dt, e
+
+def _sort_key(dt):
+    """Returns naive UTC datetime usable for comparing dates with
+    datetimes, both timezone aware and naive"""
+    if not isinstance(dt, datetime.datetime):
+        return datetime.datetime(dt.year, dt.month, dt.day)
+    if dt.utcoffset() is not None:
+        return (dt - dt.utcoffset()).replace(tzinfo=None)
+    return dt
+
+def _tag_stream(stream, i):
+    """Adds calendar index i to items of sorted ICal query result"""
+    for key, pos, dt, e in stream:
+        yield key, i, pos, dt, e
+
+def _merge_overrides(a, b):
+    """Returns union of two {uid: {key: recurrence-id}} dictionaries"""
+    ret = dict(a)
+    for uid, rids in b.items():
+        if uid in ret:
+            ret[uid] = dict(ret[uid])
+            ret[uid].update(rids)
+        else:
+            ret[uid] = rids
+    return ret
+
+def _exdate(rid, start):
+    """Returns recurrence-id converted so that it can be used as EXDATE
+    of rruleset of event starting at start"""
+    if not isinstance(rid, datetime.datetime):
+        rid = datetime.datetime(rid.year, rid.month, rid.day)
+    if isinstance(start, datetime.datetime) and start.tzinfo is not None:
+        if rid.tzinfo is None:
+            rid = rid.replace(tzinfo=start.tzinfo)
+    elif rid.tzinfo is not None:
+        rid = rid.replace(tzinfo=None)
+    return rid
+
 class Event(object):
-    def __init__(self, ical, event):
-        """__init__(ical, vevent) -> Event
+    def __init__(self, ical, event, owner = None):
+        """__init__(ical, vevent, owner=None) -> Event
 
         ical - iCal text for the event
         event - vevent instance representing given event
+        owner - ICal instance that should be notified about changes
         """
         self.uid = event.uid.value
         self.ical = ical
-        self._event = event
+        self._vevent = event
+        self._owner = owner
+
+    @property
+    def _event(self):
+        if self._owner:
+            return self._owner._current(self._vevent)
+        return self._vevent
+
+    def get_recurrence_id(self):
+        """get_recurrence_id() -> datetime.datetime, datetime.date or None
+
+        Returns RECURRENCE-ID of the event, i.e. start of occurrence of
+        recurring event this event overrides, or None if the event is
+        not an override
+        """
+        try:
+            return self._event.recurrence_id.value
+        except AttributeError:
+            return None
 
     def get_summary(self):
         """get_summary() -> str
@@ -343,7 +973,9 @@ class Event(object):
 
         Sets summary to text provided
         """
+        self._before_change()
         self._event.summary.value = summary
+        self._changed()
 
     def get_start_datetime(self):
         """get_start_datetime() -> datetime.datetime or datetime.date
@@ -357,7 +989,9 @@ class Event(object):
         """set_start_datetime(dt)
 
         Sets start datetime to provided datetime.datetime instance"""
+        self._before_change()
         self._event.dtstart.value = dt
+        self._changed()
 
     def get_end_datetime(self):
         """get_end_datetime() -> datetime.datetime or datetime.date
@@ -371,7 +1005,9 @@ class Event(object):
         """set_end_datetime(dt)
 
         Sets end datetime to provided datetime.datetime instance"""
+        self._before_change()
         self._event.dtend.value = dt
+        self._changed()
 
     def get_description(self):
         """get_description() -> str
@@ -384,7 +1020,9 @@ class Event(object):
         """set_description(description)
 
         Sets long description of the event"""
+        self._before_change()
         self._event['DESCRIPTION'] = description
+        self._changed()
 
     def get_location(self):
         """get_location() -> str
@@ -396,7 +1034,9 @@ class Event(object):
         """set_location(location)
 
         Sets location text of the event"""
+        self._before_change()
         self._event.location.value = location
+        self._changed()
 
     def get_url(self):
         """get_url() -> str
@@ -408,7 +1048,9 @@ class Event(object):
         """set_url(location)
 
         Sets url text of the event"""
+        self._before_change()
         self._event.url.value = url
+        self._changed()
 
     def get_attendees(self):
         """get_attendees() -> [Attendee]
@@ -421,7 +1063,9 @@ class Event(object):
         return ret
 
     def set_attendees(self, atlist):
+        self._before_change()
         self._event.attendee_list = atlist
+        self._changed()
 
     def get_rruleset(self):
         """get_rruleset(uid) -> dateutil.rrule.rruleset
@@ -433,6 +1077,14 @@ class Event(object):
         """
         return self._event.getrruleset()
 
+    def _before_change(self):
+        if self._owner:
+            self._owner._writable(self._vevent)
+
+    def _changed(self):
+        if self._owner:
+            self._owner._touch()
+
 
 class Attendee(object):
 
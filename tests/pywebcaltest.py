@@ -16,10 +16,16 @@
 # You should have received a copy of the GNU General Public License
 # along with pywebcal.  If not, see <http://www.gnu.org/licenses/>.
 
-from pywebcal import ICal
+from pywebcal import ICal, WebCal, CalendarRefresher, CalendarSet
+from pywebcal.pywebcal import _IncrementalParser
 import unittest
 
 import vobject
+import shutil
+import tempfile
+import threading
+import SimpleHTTPServer
+import SocketServer
 from datetime import tzinfo, timedelta, datetime, date
 
 
@@ -139,6 +145,67 @@ class ICalTest(unittest.TestCase):
         after = self.ical3.events_after(datetime(2011, 3, 3, 0, 0, 0, 0, UTC()))
         self.assertEqual(0, len(after))
 
+    def test_query_cache(self):
+        start = datetime(2010, 8, 12, 0, 0, 0, 0, UTC())
+        end = datetime(2010, 8, 24, 0, 0, 0, 0, UTC())
+        between = self.ical.events_between(start, end)
+        self.assertEqual(2, len(between))
+        again = self.ical.events_between(start, end)
+        self.assertEqual(between, again)
+        self.assertTrue(between[0][1] is again[0][1])
+        # returned lists are copies
+        again.pop()
+        self.assertEqual(2, len(self.ical.events_between(start, end)))
+
+        # edits through Event invalidate cached results
+        e = between[0][1]
+        e.set_start_datetime(date(2010, 9, 1))
+        self.assertEqual(1, len(self.ical.events_between(start, end)))
+
+    def test_query_cache_bounded(self):
+        self.ical._query_cache_size = 3
+        for day in range(1, 6):
+            self.ical.events_after(datetime(2010, 8, day, 0, 0, 0, 0, UTC()))
+        self.assertEqual(3, len(self.ical._query_cache))
+
+    def test_query_cache_threads(self):
+        self.ical._query_cache_size = 2
+        events = self.ical.get_events()
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(30):
+                    day = datetime(2010, 8, 1 + (n + i) % 5, 0, 0, 0, 0, UTC())
+                    self.ical.events_after(day)
+                    if i % 10 == 0:
+                        events[0].set_summary('Changed %d' % i)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertTrue(len(self.ical._query_cache) <= 2)
+
+    def test_floating_rrule(self):
+        c = vobject.base.readComponents(open("floating.ics","r")).next()
+        ical = ICal(c)
+        before = ical.events_before(datetime(2011, 1, 5, 12, 0, 0, 0, UTC()))
+        self.assertEqual(datetime(2011, 1, 5, 9, 0), before[0][0])
+        self.assertEqual('Standup', before[0][1].get_summary())
+
+        after = ical.events_after(datetime(2011, 1, 5, 12, 0, 0, 0, UTC()))
+        self.assertEqual(datetime(2011, 1, 6, 9, 0), after[0][0])
+        self.assertEqual('Standup', after[0][1].get_summary())
+
+        merged = list(CalendarSet([ical]).events_after(
+            datetime(2011, 1, 5, 12, 0, 0, 0, UTC())))
+        self.assertEqual([(datetime(2011, 1, 6, 9, 0), after[0][1])], merged)
+
     def test_url(self):
         ids = self.ical.get_events()
         url = ids[0].get_url()
@@ -168,6 +235,358 @@ class ICalTest(unittest.TestCase):
 
 
 
+class CalendarSetTest(unittest.TestCase):
+
+    def setUp(self):
+        c = vobject.base.readComponents(open("test.ics","r")).next()
+        self.ical = ICal(c)
+        c = vobject.base.readComponents(open("test.ics","r")).next()
+        self.ical_copy = ICal(c)
+        c = vobject.base.readComponents(open("test2.ics","r")).next()
+        self.ical2 = ICal(c)
+        c = vobject.base.readComponents(open("recurring.ics","r")).next()
+        self.recurring = ICal(c)
+
+    def test_merge_dedup(self):
+        cs = CalendarSet([self.ical, self.ical2, self.ical_copy])
+        after = list(cs.events_after(datetime(2010, 7, 10, 0, 0, 0, 0, UTC())))
+        self.assertEqual(33, len(after))
+        # duplicates are taken from the first calendar
+        self.assertTrue(after[0][1] in [e for dt, e in self.ical.events_after(
+            datetime(2010, 7, 10, 0, 0, 0, 0, UTC()))])
+
+        before = list(cs.events_before(datetime(2010, 10, 3, 0, 0, 0, 0, UTC())))
+        self.assertEqual(12, len(before))
+
+        between = list(cs.events_between(
+            datetime(2010, 8, 12, 0, 0, 0, 0, UTC()),
+            datetime(2010, 8, 24, 0, 0, 0, 0, UTC())))
+        self.assertEqual(2, len(between))
+
+    def test_ordering(self):
+        cs = CalendarSet([self.ical2, self.ical])
+        dts = [dt for dt, e in cs.events_after(datetime(2010, 7, 10, 0, 0, 0, 0, UTC()))]
+        self.assertEqual(33, len(dts))
+        self.assertEqual(datetime(2010, 7, 23, 0, 0, 0, 0, UTC()), dts[0])
+        self.assertEqual(datetime(2011, 3, 3, 11, 30, 0, 0, UTC()), dts[-1])
+        for a, b in zip(dts, dts[1:]):
+            self.assertTrue(_key(a) <= _key(b))
+
+    def test_recurrence_override(self):
+        cs = CalendarSet([self.recurring])
+        between = list(cs.events_between(
+            datetime(2011, 1, 9, 0, 0, 0, 0, UTC()),
+            datetime(2011, 1, 11, 0, 0, 0, 0, UTC())))
+        self.assertEqual(['Lunch', 'Weekly meeting (moved)'],
+                         [e.get_summary() for dt, e in between])
+        self.assertEqual(datetime(2011, 1, 10, 14, 0, 0, 0, UTC()), between[1][0])
+
+        between = list(cs.events_between(
+            datetime(2011, 1, 2, 0, 0, 0, 0, UTC()),
+            datetime(2011, 1, 4, 0, 0, 0, 0, UTC())))
+        self.assertEqual(['Weekly meeting'], [e.get_summary() for dt, e in between])
+
+    def test_sorted_streams_cached(self):
+        dt = datetime(2010, 7, 10, 0, 0, 0, 0, UTC())
+        cs = CalendarSet([self.ical, self.ical2])
+        first = list(cs.events_after(dt))
+        stream = self.ical._cached_query('after', (dt,), {}, True)
+        self.assertTrue(stream is self.ical._cached_query('after', (dt,), {}, True))
+        self.assertEqual(first, list(cs.events_after(dt)))
+
+    def test_recurrence_override_continues_series(self):
+        between = list(CalendarSet([self.recurring]).events_between(
+            datetime(2011, 1, 9, 0, 0, 0, 0, UTC()),
+            datetime(2011, 1, 20, 0, 0, 0, 0, UTC())))
+        self.assertEqual(['Lunch', 'Weekly meeting (moved)', 'Weekly meeting'],
+                         [e.get_summary() for dt, e in between])
+        self.assertEqual(datetime(2011, 1, 17, 10, 0, 0, 0, UTC()), between[2][0])
+
+        # override moved before the query start
+        text = open("recurring.ics","r").read().replace(
+            "DTSTART:20110110T140000Z\r\nDTEND:20110110T150000Z",
+            "DTSTART:20110109T140000Z\r\nDTEND:20110109T150000Z")
+        self.assertTrue("20110109T140000Z" in text)
+        moved = ICal(vobject.base.readComponents(text).next())
+        for cal in [moved, CalendarSet([moved])]:
+            after = list(cal.events_after(datetime(2011, 1, 10, 9, 0, 0, 0, UTC())))
+            self.assertEqual(['Lunch', 'Weekly meeting'],
+                             sorted([e.get_summary() for dt, e in after]))
+            self.assertEqual(datetime(2011, 1, 17, 10, 0, 0, 0, UTC()),
+                             [dt for dt, e in after
+                              if e.get_summary() == 'Weekly meeting'][0])
+
+    def test_recurrence_override_across_calendars(self):
+        master = ICal(vobject.base.readComponents(open("recurring.ics","r")).next())
+        moved = ICal(vobject.base.readComponents(open("recurring.ics","r")).next())
+        for e in master.ical.vevent_list[:]:
+            if hasattr(e, 'recurrence_id'):
+                master.ical.remove(e)
+        for e in moved.ical.vevent_list[:]:
+            if not hasattr(e, 'recurrence_id'):
+                moved.ical.remove(e)
+
+        for cals in ([master, moved], [moved, master]):
+            between = list(CalendarSet(cals).events_between(
+                datetime(2011, 1, 10, 0, 0, 0, 0, UTC()),
+                datetime(2011, 1, 11, 0, 0, 0, 0, UTC())))
+            self.assertEqual(['Lunch', 'Weekly meeting (moved)'],
+                             [e.get_summary() for dt, e in between])
+
+    def test_overrides_cached(self):
+        overrides = self.recurring._get_overrides()
+        self.assertTrue(overrides is self.recurring._get_overrides())
+        self.recurring.get_events()[1].set_summary('Changed')
+        self.assertFalse(overrides is self.recurring._get_overrides())
+        self.assertEqual(overrides, self.recurring._get_overrides())
+
+def _key(dt):
+    if not isinstance(dt, datetime):
+        return datetime(dt.year, dt.month, dt.day, tzinfo=UTC())
+    return dt
+
+class IncrementalParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = _IncrementalParser()
+        self.text = open("test.ics","r").read()
+        self.vcal = self.parser.parse(self.text)
+
+    def test_parse(self):
+        full = vobject.base.readComponents(self.text).next()
+        self.assertEqual(full.serialize(), self.vcal.serialize())
+        for f in ["test2.ics", "onlytodo.ics", "recurring.ics"]:
+            text = open(f,"r").read()
+            full = vobject.base.readComponents(text).next()
+            self.assertEqual(full.serialize(), _IncrementalParser().parse(text).serialize())
+
+    def test_reuse(self):
+        vcal = self.parser.parse(self.text.replace(
+            "SUMMARY:Grape Festival 2010", "SUMMARY:Grape Festival 2011"))
+        old, new = self.vcal.vevent_list, vcal.vevent_list
+        self.assertEqual(32, len(new))
+        self.assertFalse(old[0] is new[0])
+        self.assertEqual("Grape Festival 2011", new[0].summary.value)
+        for a, b in zip(old[1:], new[1:]):
+            self.assertTrue(a is b)
+
+    def test_shared_components(self):
+        a = ICal(self.vcal, 1, True)
+        b = ICal(self.parser.parse(self.text), 1, True)
+        self.assertTrue(a.ical.vevent_list[0] is b.ical.vevent_list[0])
+        start = datetime(2010, 8, 12, 0, 0, 0, 0, UTC())
+        end = datetime(2010, 8, 24, 0, 0, 0, 0, UTC())
+        self.assertEqual(2, len(b.events_between(start, end)))
+
+        event = a.events_between(start, end)[0][1]
+        event.set_start_datetime(date(2010, 9, 1))
+        self.assertEqual(date(2010, 9, 1), event.get_start_datetime())
+        self.assertEqual(1, len(a.events_between(start, end)))
+        self.assertEqual(date(2010, 9, 1), a.get_events()[0].get_start_datetime())
+
+        # other instance is not affected
+        self.assertEqual(date(2010, 8, 13), b.get_events()[0].get_start_datetime())
+        self.assertEqual(2, len(b.events_between(start, end)))
+        b.clear_query_cache()
+        self.assertEqual(2, len(b.events_between(start, end)))
+
+        # nor is the next parse, unchanged original is still reused
+        c = ICal(self.parser.parse(self.text), 1, True)
+        self.assertEqual(date(2010, 8, 13), c.get_events()[0].get_start_datetime())
+        self.assertTrue(b.ical.vevent_list[0] is c.ical.vevent_list[0])
+
+    def test_blank_lines(self):
+        full = vobject.base.readComponents(self.text).next().serialize()
+        for text in ["\r\n" + self.text, self.text + "\r\n",
+                     "\r\n" + self.text + "\r\n\r\n"]:
+            self.assertEqual(full, _IncrementalParser().parse(text).serialize())
+            self.assertEqual(full, self.parser.parse(text).serialize())
+
+    def test_timezone_change(self):
+        text = open("test2.ics","r").read()
+        vcal = self.parser.parse(text)
+        vcal2 = self.parser.parse(text.replace("TZOFFSETTO:+0100", "TZOFFSETTO:+0300"))
+        self.assertFalse(vcal.vevent is vcal2.vevent)
+        self.assertFalse(vcal.vtimezone is vcal2.vtimezone)
+        self.assertEqual(vcal.vevent.uid.value, vcal2.vevent.uid.value)
+
+class RefresherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.orig_cache_file = WebCal._cache_file
+        WebCal._cache_file = '%s/.pywebcal.cache' % self.tmpdir
+        self.server = FakeServer()
+        self.clock = FakeClock()
+        self.wc = WebCal(self.server.url('test.ics'))
+        self.refresher = CalendarRefresher([self.wc], interval=60, jitter=0,
+                                           retry=10, clock=self.clock)
+
+    def tearDown(self):
+        self.refresher.stop()
+        self.server.close()
+        WebCal._cache_file = self.orig_cache_file
+        shutil.rmtree(self.tmpdir)
+
+    def test_cold_read(self):
+        self.assertEqual([0], self.refresher.get_calendar_uids(self.wc))
+        cal = self.refresher.get_calendar(self.wc, 0)
+        self.assertEqual(32, len(cal.get_events()))
+        self.assertTrue(cal is self.refresher.get_calendar(self.wc, 0))
+        self.assertEqual(1, self.server.requests)
+        self.assertRaises(KeyError, self.refresher.get_calendar, self.wc, 1)
+
+    def test_stale_while_revalidate(self):
+        cal = self.refresher.get_calendar(self.wc, 0)
+        self.assertEqual(0, self.refresher.run_pending())
+
+        self.clock.now += 61
+        # stale entry is returned right away and refreshed later
+        self.assertTrue(cal is self.refresher.get_calendar(self.wc, 0))
+        self.assertEqual(1, self.server.requests)
+
+        self.assertEqual(1, self.refresher.run_pending())
+        self.assertEqual(2, self.server.requests)
+        new = self.refresher.get_calendar(self.wc, 0)
+        self.assertFalse(cal is new)
+        # unchanged events are not parsed again
+        self.assertTrue(cal.ical.vevent_list[0] is new.ical.vevent_list[0])
+
+    def test_backoff(self):
+        wc = WebCal(self.server.url('missing.ics'))
+        self.refresher.add(wc)
+        self.assertEqual(1, self.refresher.run_pending())
+        self.assertEqual(2, self.server.requests)
+
+        self.clock.now += 9
+        self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(2, self.server.requests)
+
+        self.clock.now += 1
+        self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(3, self.server.requests)
+
+        # second failure doubles retry time
+        self.clock.now += 19
+        self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(3, self.server.requests)
+
+        self.clock.now += 1
+        self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(4, self.server.requests)
+
+    def test_backoff_stale_reads(self):
+        cal = self.refresher.get_calendar(self.wc, 0)
+        self.server.fail = True
+
+        self.clock.now += 61
+        self.assertTrue(cal is self.refresher.get_calendar(self.wc, 0))
+        self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(2, self.server.requests)
+
+        # stale reads do not shorten backoff
+        for i in range(9):
+            self.clock.now += 1
+            self.assertTrue(cal is self.refresher.get_calendar(self.wc, 0))
+            self.assertEqual(0, self.refresher.run_pending())
+        self.assertEqual(2, self.server.requests)
+
+        self.clock.now += 1
+        self.server.fail = False
+        self.assertEqual(1, self.refresher.run_pending())
+        self.assertEqual(3, self.server.requests)
+
+    def test_cold_read_backoff(self):
+        wc = WebCal(self.server.url('missing.ics'))
+        self.assertRaises(Exception, self.refresher.get_calendar, wc, 0)
+        self.assertEqual(1, self.server.requests)
+
+        # failure is remembered until backoff time passes
+        self.clock.now += 9
+        self.assertRaises(Exception, self.refresher.get_calendar_uids, wc)
+        self.assertRaises(Exception, self.refresher.get_calendar, wc, 0)
+        self.assertEqual(1, self.server.requests)
+
+        self.clock.now += 1
+        self.assertRaises(Exception, self.refresher.get_calendar, wc, 0)
+        self.assertEqual(2, self.server.requests)
+
+    def test_stop_between_refreshes(self):
+        for i in range(3):
+            self.refresher.add(WebCal(self.server.url('missing%d.ics' % i)))
+        self.refresher._stopping = True
+        self.assertEqual(0, self.refresher._run_pending(True))
+        self.assertEqual(0, self.server.requests)
+        self.assertEqual(1, self.refresher.run_pending())
+        self.assertEqual(4, self.server.requests)
+
+    def test_calendar_set(self):
+        cs = CalendarSet(self.wc, self.refresher)
+        dt = datetime(2010, 7, 10, 0, 0, 0, 0, UTC())
+        self.assertEqual(32, len(list(cs.events_after(dt))))
+        self.assertEqual(32, len(list(cs.events_after(dt))))
+        self.assertEqual(1, self.server.requests)
+
+    def test_get_calendar_independent(self):
+        self.wc.get_calendar_uids()
+        a = self.wc.get_calendar(0)
+        a.ical.vevent_list[0].summary.value = 'LOCAL EDIT'
+        b = self.wc.get_calendar(0)
+        self.assertEqual('Grape Festival 2010', b.get_events()[0].get_summary())
+        self.assertFalse(a.ical.vevent_list[1] is b.ical.vevent_list[1])
+
+        c = self.wc.get_calendar(0, shared=True)
+        d = self.wc.get_calendar(0, shared=True)
+        self.assertTrue(c.ical.vevent_list[1] is d.ical.vevent_list[1])
+
+    def test_background_thread(self):
+        self.refresher.start()
+        self.refresher.get_calendar_uids(self.wc)
+        self.refresher.stop(5)
+        self.assertFalse(self.refresher._thread)
+        self.assertEqual(32, len(self.refresher.get_calendar(self.wc, 0).get_events()))
+
+
+class FakeServer(object):
+    """Serves files from tests directory over HTTP and counts requests"""
+
+    def __init__(self):
+        server = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server.fail:
+                    self.send_error(500)
+                    return
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.requests = 0
+        self.fail = False
+        self._httpd = SocketServer.TCPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self._httpd.server_address[1], name)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
 ZERO = timedelta(0)
 HOUR = timedelta(hours=1)
 